@@ -0,0 +1,18 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+
+"""
+Shared import bootstrap for every entry point
+
+Puts the thrift generated code directory on sys.path exactly once. The
+module body only runs on first import, so files can simply
+`import _bootstrap` instead of each appending "gen-py" and re-triggering
+CPython's path-entry importer scan
+"""
+
+_GEN_PY = os.path.join(os.path.dirname(os.path.abspath(__file__)), "gen-py")
+
+if _GEN_PY not in sys.path:
+    sys.path.append(_GEN_PY)
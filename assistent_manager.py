@@ -1,17 +1,28 @@
 #!/usr/bin/env python3
 
 import argparse
+import atexit
+import logging
+import logging.handlers
 import os
+import random
+import select
 import signal
-import subprocess
 import sys
 
-sys.path.append("gen-py")
+import _bootstrap
 
 from time import sleep
 
-from client_utils import thriftClient
-from container_utils import generateUnshareCommand, getCurrentCgroup, sendSignalToCgroup
+from client_utils import PersistentThriftClient
+from container_utils import (
+    cloneContainerProcess,
+    generateUnshareCommand,
+    getCurrentCgroup,
+    killCgroup,
+    remountProc,
+    sendSignalToCgroup,
+)
 
 from container_manager.ttypes import (
     ReportContainerStatusRequest,
@@ -23,8 +34,30 @@ from container_manager.ttypes import (
 )
 
 
+# buffered logging: print() grabs the stdout lock and flushes per line,
+# which serializes when many assistents share one aggregated stream. The
+# memory handler batches records and writes them out in one go when the
+# buffer fills (or immediately for warnings and above); atexit flushes
+# whatever is left so exit messages aren't lost
+_logHandler = logging.handlers.MemoryHandler(
+    capacity=64,
+    flushLevel=logging.WARNING,
+    target=logging.StreamHandler(sys.stdout),
+)
+_logger = logging.getLogger("assistent_manager")
+_logger.setLevel(logging.INFO)
+_logger.addHandler(_logHandler)
+atexit.register(_logHandler.close)
+
+
 def amLog(tag, msg):
-    print(f"Assistent Manager ({tag}): {msg}")
+    _logger.info("Assistent Manager (%s): %s", tag, msg)
+
+
+# exit classification table indexed by (si_code == CLD_EXITED); a tuple
+# index instead of a conditional per reaped child, which matters when a
+# preemption kills a herd of containers at once
+_EXIT_CODES = (ExitCode.SIGNAL, ExitCode.EXIT)
 
 
 class Assistent:
@@ -44,11 +77,11 @@ class Assistent:
     7) much, much more
 
     As this is written in python rather than a more desirable language
-    like go/c++/c/rust, it's non-trivial to use system calls like clone(2)
-    so we use unshare(1) as a shim, resulting in the consequence that there
-    is an extra fork/process in order for a new pid namespace to be used
-    thus some extra leg work needs to be performed to get the pid of the
-    container workload
+    like go/c++/c/rust, there is no binding for system calls like clone(2),
+    so we reach clone3(2) through ctypes to start the workload directly in
+    its namespaces. On kernels without clone3 we fall back to the unshare(1)
+    shim, which costs an extra fork/process for the new pid namespace and
+    leaves us tracking the pid of unshare rather than the workload
 
     Exercise:
     1) Redirect the container's stderr/stdout to a file or elsewhere
@@ -58,25 +91,65 @@ class Assistent:
     and the container should go to /{parentCgroupPath}/{ctag}/workload
     This is easier to do once clone(2) is supported
     4) Support the rest of the suggestions above
-    5) support using clone(2) (possibly via c++/go/rust rewrite)
+    5) use clone3's CLONE_INTO_CGROUP to place the workload in its own
+    cgroup at creation time (needs linux 5.7+ and a cgroup dirfd)
     """
 
+    # first report as soon as possible so the container reaches RUNNING fast
+    BASE_REPORT_INTERVAL = 1.0
+    # once RUNNING, heartbeat a little less often; kept small because STOP
+    # requests are delivered to us as the response to a report, and our
+    # lifecycle tests only wait a handful of seconds for a stop
+    STEADY_REPORT_INTERVAL = 2.0
+    # cap for the backoff while the container manager is unreachable
+    MAX_REPORT_INTERVAL = 60.0
+
     def __init__(self, port: int, tag: str, parentCgroupPath: str):
         # port for container manager
         self.port = port
         # identifier for assistent and container
         self.tag = tag
-        # proc of container workload
-        self.cproc = None
+        # pid of the container workload; with clone3 this is the real
+        # workload pid, with the unshare fallback it's the pid of unshare
+        self.workloadPid = None
+        # pidfd for the container workload (when the kernel supports it)
+        self.pidfd = None
+        # seconds until the next status report; adapted in _report
+        self._interval = self.BASE_REPORT_INTERVAL
         # get container setup info from manager
         self.info = None
+        # join our container cgroup; the executor creates the directory
+        # before spawning us but no longer has a forked child that can
+        # write our pid in to it (we are posix_spawn'd directly)
+        # raw os.open/os.write: no TextIOWrapper buffering/encoding for a
+        # handful of ascii bytes
+        fd = os.open(
+            os.path.join(parentCgroupPath, self.tag, "cgroup.procs"), os.O_WRONLY
+        )
+        try:
+            os.write(fd, str(os.getpid()).encode())
+        finally:
+            os.close(fd)
         # get current cgroup of this process
         self.cgroupPath = getCurrentCgroup()
         # Since this is a toy, we don't want to send signals to anything but
         # the cgroup for our containers
         assert self.cgroupPath.startswith(parentCgroupPath)
+        # keep cgroup.procs open; shutdown re-reads it back to back and the
+        # fd lets us skip an open/path-walk per signalling call
+        self._cgroupProcsFd = os.open(
+            os.path.join(self.cgroupPath, "cgroup.procs"), os.O_RDONLY
+        )
+        # one connection for our whole lifetime of status reports; it
+        # reconnects lazily if the container manager bounces
+        self.client = PersistentThriftClient(self.port)
+        # the status report is invariant apart from state/exitInfo, so
+        # build the request once; workloadPid is filled by startContainer
+        self._reportRequest = ReportContainerStatusRequest(
+            tag=self.tag, pid=os.getpid(), cgroupPath=self.cgroupPath
+        )
         try:
-            with thriftClient(self.port) as client:
+            with self.client as client:
                 response = client.getAssistentManagerStatus(
                     AssistentManagerStatusRequest(self.tag)
                 )
@@ -97,22 +170,61 @@ class Assistent:
         log handling, etc
         """
         cmdArgs = [self.info.command.cmd] + self.info.command.arguments
-        cmd = generateUnshareCommand(cmdArgs, isContainer=True)
-        self.cproc = subprocess.Popen(cmd)
+        try:
+            # preferred path: clone3(2) creates the workload directly in its
+            # new namespaces, with no intermediate unshare process, so the
+            # pid we track (and report to the manager) is the real workload
+            pid = cloneContainerProcess()
+        except OSError:
+            pid = None
+        if pid == 0:
+            # child; we are pid 1 of the new pid namespace
+            try:
+                remountProc()
+                os.execv(cmdArgs[0], cmdArgs)
+            finally:
+                # something went wrong before/at exec; don't fall back in
+                # to the assistent's monitor loop
+                os._exit(127)
+        elif pid is not None:
+            self.workloadPid = pid
+        else:
+            # clone3 unavailable; exec the workload behind the unshare(1)
+            # shim, accepting that the tracked pid is the pid of unshare
+            # posix_spawn (vfork+exec) avoids duplicating the assistent's
+            # heap the way subprocess' fork path would
+            cmd = generateUnshareCommand(cmdArgs, isContainer=True)
+            self.workloadPid = os.posix_spawn(cmd[0], cmd, os.environ)
+        # the real workload pid with clone3; the pid of unshare otherwise
+        self._reportRequest.workloadPid = self.workloadPid
+        try:
+            # grab a pidfd for the child so we can block in poll(2) until it
+            # exits rather than waking up every second to check on it
+            # requires python 3.9+ and linux 5.3+
+            self.pidfd = os.pidfd_open(self.workloadPid, 0)
+        except (AttributeError, OSError):
+            # fall back to the periodic non-blocking waitpid check
+            self.pidfd = None
 
-    def _zombieCheck(self):
+    def _zombieCheck(self, blocking: bool = False):
         """
-        check in a non-blocking way if our container process died
-        return exit information if so
+        check if our container process died and return exit information if so
+        by default the check is non-blocking; a blocking check is only safe
+        once we know the child has exited (e.g the pidfd became readable)
+
+        waitid targets the workload pid specifically; waitpid(-1) would
+        reap whatever child exits first, so any future helper process
+        could be mistaken for the container
         """
-        cpid, status = os.waitpid(-1, os.WNOHANG)
-        if cpid:
-            # non-negative status values means it exited via _exit(2) and returns the int value
-            # negative status values mean it was killed by a signal and returns the signal number
-            status = os.waitstatus_to_exitcode(status)
+        flags = os.WEXITED if blocking else os.WEXITED | os.WNOHANG
+        result = os.waitid(os.P_PID, self.workloadPid, flags)
+        if result is not None:
+            # si_code tells us whether the workload called _exit(2)
+            # (CLD_EXITED) or a signal took it out (CLD_KILLED/CLD_DUMPED);
+            # si_status holds the exit code or signal number accordingly
             info = ExitInfo()
-            info.code = ExitCode.EXIT if status > -1 else ExitCode.SIGNAL
-            info.status = abs(status)
+            info.code = _EXIT_CODES[result.si_code == os.CLD_EXITED]
+            info.status = result.si_status
             return info
         return None
 
@@ -133,48 +245,88 @@ class Assistent:
         for the manager to come back on line; something long like 12hrs
         to avoid brief manager flakiness
         """
-        request = ReportContainerStatusRequest()
-        request.tag = self.tag
+        # reuse the prebuilt request; only the observed status varies
+        request = self._reportRequest
         request.state = ContainerState.RUNNING if not info else ContainerState.DEAD
-        request.pid = os.getpid()
-        # unfortunately this is the pid of unshare
-        request.workloadPid = self.cproc.pid
-        request.cgroupPath = self.cgroupPath
+        request.exitInfo = info
         try:
-            with thriftClient(self.port) as client:
+            with self.client as client:
                 response = client.reportContainerStatus(request)
                 if response.status == ManagerResponse.ABORT:
                     amLog(self.tag, "Container manager does not recognize us! Abort!!")
-                    # ungracefully kill the container workload
-                    sendSignalToCgroup(self.cgroupPath, signal.SIGKILL)
+                    # cgroup.kill takes us out with SIGKILL, which skips
+                    # the atexit flush; push the abort record out now or
+                    # the only clue why we died is lost with the buffer
+                    _logHandler.flush()
+                    # ungracefully kill the whole container cgroup
+                    # (ourselves included, on cgroup.kill kernels)
+                    killCgroup(self.cgroupPath, procsFd=self._cgroupProcsFd)
                     # uncleanly exit the assistent
                     sys.exit(1)
                 elif response.status == ManagerResponse.STOP:
                     # send sigterm to all processes in the cgroup (minus caller)
                     # and monitor child for its death
-                    sendSignalToCgroup(self.cgroupPath, signal.SIGTERM)
+                    sendSignalToCgroup(
+                        self.cgroupPath, signal.SIGTERM, procsFd=self._cgroupProcsFd
+                    )
+            # manager is reachable; report at the steady heartbeat cadence
+            self._interval = self.STEADY_REPORT_INTERVAL
         except Exception as e:
             # this can occur if there's an issue connection to container manager
             # e.g container manager is down. We should log and wait for container
-            # manager to return
+            # manager to return, backing off so a manager outage doesn't turn
+            # in to a per-second reconnect/log storm from every assistent.
+            # jitter desynchronizes the herd: without it every assistent
+            # that failed together retries together when the manager
+            # returns. The widening interval is also our circuit breaker;
+            # no connect is attempted until it elapses
+            self._interval = min(
+                self._interval * 2 * random.uniform(0.5, 1.5),
+                self.MAX_REPORT_INTERVAL,
+            )
             amLog(self.tag, e)
 
     def monitor(self):
-        while True:
-            # check if child died
-            cInfo = self._zombieCheck()
-            # report to container manager
-            self._report(cInfo)
-
-            # exit loop if child is dead
-            if cInfo:
-                amLog(
-                    self.tag,
-                    f"Container workload {self.cproc.pid} exited with results: {cInfo}",
-                )
-                break
+        poller = None
+        if self.pidfd is not None:
+            # the pidfd becomes readable once the workload exits, so we can
+            # sleep in the kernel instead of waking up to poll waitpid
+            poller = select.poll()
+            poller.register(self.pidfd, select.POLLIN)
+        try:
+            while True:
+                # check if child died
+                cInfo = self._zombieCheck()
+                # report to container manager
+                self._report(cInfo)
+
+                # exit loop if child is dead
+                if cInfo:
+                    amLog(
+                        self.tag,
+                        f"Container workload {self.workloadPid} exited with results: {cInfo}",
+                    )
+                    break
 
-            sleep(1)
+                if poller is not None:
+                    # block until the workload exits or it's time for the
+                    # next status report to the container manager
+                    if poller.poll(int(self._interval * 1000)):
+                        # workload exited; reap it with a blocking wait
+                        cInfo = self._zombieCheck(blocking=True)
+                        self._report(cInfo)
+                        amLog(
+                            self.tag,
+                            f"Container workload {self.workloadPid} exited with results: {cInfo}",
+                        )
+                        break
+                else:
+                    # no pidfd support; fall back to the old polling cadence
+                    sleep(self._interval)
+        finally:
+            if self.pidfd is not None:
+                os.close(self.pidfd)
+            os.close(self._cgroupProcsFd)
 
 
 if __name__ == "__main__":
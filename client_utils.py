@@ -1,35 +1,157 @@
 #!/usr/bin/env python3
 
-import sys
+import collections
+import errno
+import select
+import socket
 import time
 
-sys.path.append("gen-py")
+import _bootstrap
 
 from contextlib import contextmanager
 
 from thrift.transport import TSocket
 from thrift.transport import TTransport
-from thrift.protocol import TBinaryProtocol
+from thrift.protocol import TCompactProtocol
 
 from container_manager import ContainerManager
 from container_manager.ttypes import ContainerState, ListContainerRequest
 
 
+def _tuneSocket(sock: socket.socket) -> None:
+    """
+    Disable Nagle's algorithm on an open socket; our request/response pairs
+    are tiny and we don't want them coalesced behind a 40ms delay
+    Keep-alive lets long-lived idle connections notice a dead peer; the
+    default 2 hour probing schedule is useless for that, so tighten it to
+    notice within roughly half a minute (keep-alive granularity is whole
+    seconds, so that's as aggressive as TCP gets)
+    """
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, 15)
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, 5)
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, 3)
+
+
+class ClientPool:
+    """
+    Process wide pool of idle thrift connections keyed by (host, port)
+
+    thriftClient borrows a connection and returns it on clean exit, so a
+    burst of one-shot calls pays one TCP+transport setup instead of one
+    per call. Idle connections carry a TTL: a stale socket (e.g the
+    server may have bounced while we sat idle) is closed on borrow rather
+    than handed to a caller. Callers here are single threaded processes,
+    so the pool does no locking of its own
+    """
+
+    # how long an idle connection stays eligible for reuse
+    IDLE_TTL = 30.0
+    # cap of idle connections kept per endpoint
+    MAX_IDLE = 4
+
+    def __init__(self):
+        self._idle = {}
+
+    def acquire(self, host: str, port: int):
+        idle = self._idle.get((host, port))
+        now = time.time()
+        while idle:
+            expiry, transport, client = idle.popleft()
+            if expiry > now:
+                return transport, client
+            # too old to trust; drop it
+            transport.close()
+        tsocket = TSocket.TSocket(host, port)
+        transport = TTransport.TFramedTransport(tsocket)
+        protocol = TCompactProtocol.TCompactProtocol(transport)
+        client = ContainerManager.Client(protocol)
+        transport.open()
+        _tuneSocket(tsocket.handle)
+        return transport, client
+
+    def release(self, host: str, port: int, transport, client):
+        idle = self._idle.setdefault((host, port), collections.deque())
+        if len(idle) >= self.MAX_IDLE:
+            transport.close()
+            return
+        idle.append((time.time() + self.IDLE_TTL, transport, client))
+
+
+_clientPool = ClientPool()
+
+
 @contextmanager
 def thriftClient(port: int):
     """
     Context manager to safely provide a thrift client that attempts to clean
     itself up on failures
+
+    Connections are borrowed from the process wide pool and returned on
+    clean exit; a failed call's connection is torn down instead of being
+    put back
     """
-    transport = TSocket.TSocket("localhost", port)
-    transport = TTransport.TBufferedTransport(transport)
-    protocol = TBinaryProtocol.TBinaryProtocol(transport)
-    client = ContainerManager.Client(protocol)
+    transport, client = _clientPool.acquire("localhost", port)
     try:
-        transport.open()
         yield client
-    finally:
+    except Exception:
         transport.close()
+        raise
+    else:
+        _clientPool.release("localhost", port, transport, client)
+
+
+class PersistentThriftClient:
+    """
+    A long-lived thrift client for callers that issue repeated requests
+    to the same server.
+
+    Unlike thriftClient, the transport stays open across calls so we pay
+    one TCP handshake for a burst of requests rather than one per request.
+    On failure the transport is torn down and the next use reconnects
+    lazily, so callers can keep re-using the same instance across server
+    restarts. One-shot callers should keep using thriftClient
+    """
+
+    def __init__(self, port: int, host: str = "localhost"):
+        self.host = host
+        self.port = port
+        self._socket = None
+        self._transport = None
+        self._client = None
+
+    def _connect(self):
+        self._socket = TSocket.TSocket(self.host, self.port)
+        self._transport = TTransport.TFramedTransport(self._socket)
+        protocol = TCompactProtocol.TCompactProtocol(self._transport)
+        client = ContainerManager.Client(protocol)
+        self._transport.open()
+        _tuneSocket(self._socket.handle)
+        self._client = client
+
+    def close(self):
+        if self._transport is not None:
+            try:
+                self._transport.close()
+            except Exception:
+                # best effort; we're dropping the connection either way
+                pass
+        self._socket = None
+        self._transport = None
+        self._client = None
+
+    def __enter__(self):
+        if self._client is None:
+            self._connect()
+        return self._client
+
+    def __exit__(self, excType, exc, tb):
+        # keep the connection open on success; tear it down on failure so
+        # the next call reconnects from scratch
+        if excType is not None:
+            self.close()
+        return False
 
 
 def containerInState(port: int, tag: str, state: ContainerState) -> bool:
@@ -47,28 +169,45 @@ def containerInState(port: int, tag: str, state: ContainerState) -> bool:
 def waitFor(condition, *args, timeout=5, **kwargs) -> bool:
     """
     Wait for up to timeout seconds for the condition function to be satisfied
+
+    Backs off exponentially from 5ms to 100ms between checks: conditions
+    that flip quickly are noticed almost immediately, while slow ones
+    aren't hammered with checks. Lifecycle state waits moved to the
+    server-side waitForContainerState; this remains for conditions with
+    no RPC to block on (e.g a server accepting connections)
     """
     deadline = time.time() + timeout
+    attempt = 0
     while time.time() < deadline:
         if condition(*args, **kwargs):
             return True
-        time.sleep(0.5)
+        time.sleep(min(0.005 * 2 ** attempt, 0.1))
+        attempt += 1
     return False
 
 
-def isServerUp(port) -> bool:
+def isServerUp(port, timeout: float = 1.0) -> bool:
     """
-    Try to establish a connection with the server
-    if server isn't up an exeception will be thrown
+    Check if the server's port is accepting connections
+    A bare TCP connect is enough here; no need to build up and tear down
+    a whole thrift transport just to probe readiness
+
+    The connect is non-blocking: EINPROGRESS plus a select on writability
+    has the kernel wake us the instant the handshake resolves, instead of
+    a blocking connect sitting out its full timeout
     """
-    try:
-        with thriftClient(port) as client:
-            # server is up
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.setblocking(False)
+        err = sock.connect_ex(("localhost", port))
+        if err == 0:
             return True
-    except Exception as e:
-        # server is not up
-        pass
-    return False
+        if err != errno.EINPROGRESS:
+            return False
+        _, writable, _ = select.select([], [sock], [], timeout)
+        if not writable:
+            return False
+        # writability alone doesn't mean success; check the real verdict
+        return sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR) == 0
 
 
 def waitForServer(port, timeout=5) -> None:
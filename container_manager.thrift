@@ -98,10 +98,35 @@ struct ListContainerRequest {
     1: list<string> tags
 }
 
+/**
+ * A single container operation for use in a batched submission.
+ * Exactly one field should be set per op
+ */
+union ContainerOp {
+    1: CreateContainerRequest create
+    2: StartContainerRequest start
+    3: StopContainerRequest stop
+    4: DeleteContainerRequest erase
+}
+
+struct SubmitContainerOpsRequest {
+    1: list<ContainerOp> ops
+}
+
 struct ListContainerResponse {
     1: list<ContainerInfo> containerInfos
 }
 
+struct WaitForStateRequest {
+    1: string tag
+    2: ContainerState state
+    3: i32 timeoutMs
+}
+
+struct WaitForStateResponse {
+    1: bool reached
+}
+
 struct ContainerIdResponse {
     1: list<string> tags
 }
@@ -166,10 +191,20 @@ service ContainerManager {
     // List all known container instances (in any state)
     ListContainerResponse listContainers(1: ListContainerRequest request) throws (1:InvalidOperation error),
 
+    // Apply a batch of container operations in order in one round trip
+    // e.g create+start a container with a single request
+    void submitContainerOps(1: SubmitContainerOpsRequest request) throws (1:InvalidOperation error),
+
+    // Block until a container reaches the given state (or timeout), saving
+    // the caller from sleep-polling listContainers
+    WaitForStateResponse waitForContainerState(1: WaitForStateRequest request) throws (1:InvalidOperation error),
+
     /* API for the executor to use */
-    
+
     // Empty the queue of ready containers (for transitioning to running)
-    ContainerIdResponse dequeueReadyContainers(),
+    // A non-zero timeoutMs turns this in to a long poll: the call blocks
+    // until a container becomes runnable or the timeout expires
+    ContainerIdResponse dequeueReadyContainers(1: i32 timeoutMs = 0),
 
     // Get all running containers
     ContainerIdResponse getRunningContainers(),
@@ -180,5 +215,10 @@ service ContainerManager {
     AssistentManagerStatusResponse getAssistentManagerStatus(1: AssistentManagerStatusRequest request),
 
     // Report the container's status to the container manager
-    ReportContainerStatusResponse reportContainerStatus(1: ReportContainerStatusRequest request)
+    ReportContainerStatusResponse reportContainerStatus(1: ReportContainerStatusRequest request),
+
+    // Report several container statuses in one round trip; responses are
+    // returned in request order. Useful for callers reporting on behalf
+    // of several containers at once
+    list<ReportContainerStatusResponse> reportContainerStatusBatch(1: list<ReportContainerStatusRequest> requests)
 }
@@ -1,24 +1,120 @@
 #!/usr/bin/env python3
+import ctypes
 import os
 import signal
 
-from typing import List, Set
+from typing import List, Optional, Set, Union
 
 """ Various utilities to manage namespaces and cgroups """
 
+# clone(2) namespace flags (see linux/sched.h)
+CLONE_NEWNS = 0x00020000
+CLONE_NEWCGROUP = 0x02000000
+CLONE_NEWUTS = 0x04000000
+CLONE_NEWIPC = 0x08000000
+CLONE_NEWPID = 0x20000000
+
+# mount(2) flags needed to emulate unshare(1) --mount-proc
+MS_REC = 0x4000
+MS_PRIVATE = 1 << 18
+
+# same syscall number on x86_64 and aarch64
+_SYS_CLONE3 = 435
+
+# lazily loaded libc handle for the raw syscalls python has no binding for
+_libc = None
+
+
+def _getLibc():
+    global _libc
+    if _libc is None:
+        _libc = ctypes.CDLL(None, use_errno=True)
+    return _libc
+
+
+class _CloneArgs(ctypes.Structure):
+    """ struct clone_args from linux/sched.h; every field is a u64 """
+
+    _fields_ = [
+        (name, ctypes.c_uint64)
+        for name in (
+            "flags",
+            "pidfd",
+            "child_tid",
+            "parent_tid",
+            "exit_signal",
+            "stack",
+            "stack_size",
+            "tls",
+            "set_tid",
+            "set_tid_size",
+            "cgroup",
+        )
+    ]
+
+
+def cloneContainerProcess() -> int:
+    """
+    fork-like wrapper around clone3(2) that creates the child directly in
+    fresh pid, mount, ipc, uts, and cgroup namespaces -- the role the
+    unshare(1) --fork shim plays for us, minus the extra intermediate
+    process (and thus the pid confusion it causes for callers)
+
+    Returns the child pid in the parent and 0 in the child; the child is
+    pid 1 of the new pid namespace. Raises OSError (e.g ENOSYS on old
+    kernels) so callers can fall back to the unshare shim
+    NOTE: python has no clone binding so this goes through ctypes; the
+    child should exec quickly as it bypasses CPython's fork bookkeeping
+    """
+    args = _CloneArgs()
+    args.flags = (
+        CLONE_NEWPID | CLONE_NEWNS | CLONE_NEWIPC | CLONE_NEWUTS | CLONE_NEWCGROUP
+    )
+    # deliver SIGCHLD on exit like fork(2), or wait(2) won't find the child
+    args.exit_signal = signal.SIGCHLD
+    libc = _getLibc()
+    pid = libc.syscall(_SYS_CLONE3, ctypes.byref(args), ctypes.sizeof(args))
+    if pid < 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err))
+    return pid
+
+
+def remountProc() -> None:
+    """
+    Emulate unshare(1) --mount-proc inside a fresh mount + pid namespace:
+    make our mount tree private so nothing propagates to the host, then
+    mount a procfs that matches the new pid namespace
+    """
+    libc = _getLibc()
+    if libc.mount(b"none", b"/", None, MS_REC | MS_PRIVATE, None) != 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err))
+    if libc.mount(b"proc", b"/proc", b"proc", 0, None) != 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err))
+
 
 def recursivelyDeleteCgroups(cgroupPath: os.PathLike) -> None:
     """
     Delete leaf nodes before parents
     Ignore the files in the directories
     they can't actually be removed due to cgroupfs semantics
+
+    We use scandir rather than os.walk as the DirEntry type check comes
+    straight from the readdir data, avoiding an extra stat per entry and
+    the list materialization os.walk does
     """
-    for root, dirs, _ in os.walk(cgroupPath, topdown=False):
-        # remove all the leafs first
-        for d in dirs:
-            os.rmdir(os.path.join(root, d))
-        # remove the root directory
-        os.rmdir(root)
+    with os.scandir(cgroupPath) as it:
+        for entry in it:
+            if entry.is_dir(follow_symlinks=False):
+                recursivelyDeleteCgroups(entry.path)
+    os.rmdir(cgroupPath)
+
+
+# cache for getCurrentCgroup; a process' cgroup is fixed at startup for
+# our purposes so there's no reason to re-read procfs per call
+_currentCgroup = None
 
 
 def getCurrentCgroup():
@@ -27,16 +123,31 @@ def getCurrentCgroup():
     see https://man7.org/linux/man-pages/man7/cgroups.7.html for format
     NOTE: This only cgroup v2 is supported
     NOTE: We also assume /sys/fs/cgroup is the mount point for cgroupfs
+
+    /proc/self/cgroup is tiny, so read it raw instead of building up a
+    whole buffered TextIOWrapper for one line
     """
-    with open(f"/proc/self/cgroup", "r") as f:
-        cgroupEntry = f.readline()
-        _, _, relCgroupPath = cgroupEntry.split(":")
-        return os.path.join("/sys/fs/cgroup", relCgroupPath.lstrip("/").rstrip())
+    global _currentCgroup
+    if _currentCgroup is None:
+        fd = os.open("/proc/self/cgroup", os.O_RDONLY)
+        try:
+            data = os.read(fd, 4096)
+        finally:
+            os.close(fd)
+        cgroupEntry = data.split(b"\n", 1)[0]
+        _, _, relCgroupPath = cgroupEntry.split(b":", 2)
+        _currentCgroup = os.path.join(
+            "/sys/fs/cgroup", relCgroupPath.decode().lstrip("/").rstrip()
+        )
+    return _currentCgroup
 
 
-def getPidsFromCgroup(cgroupPath: os.PathLike) -> Set[int]:
+def getPidsFromCgroup(cgroup: Union[os.PathLike, int]) -> Set[int]:
     """
     Get every pid belonging to the given cgroup
+    Accepts either the cgroup directory path or an already open fd for its
+    cgroup.procs file; with an fd we just rewind and re-read in place,
+    saving the path walk and open/close per call for repeat callers
 
     The cgroup.procs file can be read to obtain a list of the
     processes that are members of a cgroup.  The returned list of
@@ -45,29 +156,85 @@ def getPidsFromCgroup(cgroupPath: os.PathLike) -> Set[int]:
     reading from the list.)
     see https://man7.org/linux/man-pages/man7/cgroups.7.html for more
     """
-    pids = set()
-    filename = os.path.join(cgroupPath, "cgroup.procs")
-    with open(filename, "r") as f:
-        # for every line in cgroup.procs, convert to int and store
-        for line in f.readlines():
-            pids.add(int(line))
-    return pids
+    if isinstance(cgroup, int):
+        fd = cgroup
+        ownFd = False
+        os.lseek(fd, 0, os.SEEK_SET)
+    else:
+        fd = os.open(os.path.join(cgroup, "cgroup.procs"), os.O_RDONLY)
+        ownFd = True
+    try:
+        data = bytearray()
+        while True:
+            # large cgroups (think fork bombs) can hold thousands of pids,
+            # so keep reading until EOF
+            chunk = os.read(fd, 1 << 20)
+            if not chunk:
+                break
+            data += chunk
+    finally:
+        if ownFd:
+            os.close(fd)
+    # one C-level split/map instead of a python loop per line
+    # NOTE: a hand-rolled per-byte parse was considered for very large
+    # cgroups, but in CPython a bytecode loop over the buffer loses badly
+    # to split/map running in C, and jit compilers aren't a dependency
+    # this toy wants
+    return set(map(int, data.split()))
+
+
+def _writeCgroupFile(cgroupPath: os.PathLike, name: str, value: str) -> bool:
+    """
+    Best effort write to a cgroup control file
+    Returns False when the kernel doesn't expose the file (e.g cgroup.kill
+    needs linux 5.14+) so callers can fall back to a per-pid approach
+
+    Raw os.open/os.write; control file payloads are a few ascii bytes and
+    don't need a buffered TextIOWrapper built per write
+    """
+    try:
+        fd = os.open(os.path.join(cgroupPath, name), os.O_WRONLY)
+    except OSError:
+        return False
+    try:
+        os.write(fd, value.encode())
+        return True
+    except OSError:
+        return False
+    finally:
+        os.close(fd)
 
 
 def sendSignalToCgroup(
-    cgroupPath: os.PathLike, sig: signal.Signals, pidsToIgnore: List[int] = None
+    cgroupPath: os.PathLike,
+    sig: signal.Signals,
+    pidsToIgnore: List[int] = None,
+    procsFd: Optional[int] = None,
 ) -> None:
     """
     Send the given signal to all processes in the given cgroup, except for
     the calling process (if it's in the cgroup) and the given ignore set
-    NOTE: This is a best effort call. Technically it does not handle fork
-    bombs. Freezing the cgroup first, systemctl kill, or killall5 type of solutions
-    would be a better way to go about it
+
+    For SIGKILL with no ignore set we write to cgroup.kill (linux 5.14+),
+    which kills every member atomically in one syscall with no window for
+    a fork bomb to outrun us. NOTE: that includes the calling process if
+    it lives in the cgroup, which is what our abort path wants anyway
+
+    Otherwise this is a best effort per-pid loop. Technically it does not
+    handle fork bombs; we can't use the usual freeze-first trick
+    (e.g systemd's cg_kill) because our callers live inside the cgroup
+    they're signalling and would freeze themselves
     e.g https://github.com/systemd/systemd/blob/bf1886226724b3db0779d643195d428575cff0be/src/basic/cgroup-util.c#L250
     or
     https://github.com/limingth/sysvinit/blob/master/sysvinit-2.88dsf/src/killall5.c#L1063
     """
-    pids = getPidsFromCgroup(cgroupPath)
+    if sig == signal.SIGKILL and not pidsToIgnore:
+        # one atomic syscall for the whole cgroup; fall through to the
+        # per-pid loop on kernels without cgroup.kill
+        if _writeCgroupFile(cgroupPath, "cgroup.kill", "1"):
+            return
+    # repeat callers can hand us their cached cgroup.procs fd
+    pids = getPidsFromCgroup(procsFd if procsFd is not None else cgroupPath)
     # don't send a signal to ourselves
     pids.discard(os.getpid())
 
@@ -77,8 +244,35 @@ def sendSignalToCgroup(
             pids.discard(pid)
 
     for pid in pids:
-        # send signal to the rest
-        os.kill(pid, sig)
+        # send signal to the rest; a pid can exit between the procs read
+        # and the kill, which is fine for a best effort sweep
+        try:
+            os.kill(pid, sig)
+        except ProcessLookupError:
+            pass
+
+
+def killCgroup(cgroupPath: os.PathLike, procsFd: Optional[int] = None) -> None:
+    """
+    Ungracefully kill every process in the given cgroup, the caller
+    included if it lives there. On linux 5.14+ this is one atomic
+    cgroup.kill write for the whole cgroup; older kernels fall back to
+    the per-pid SIGKILL loop in sendSignalToCgroup
+    """
+    sendSignalToCgroup(cgroupPath, signal.SIGKILL, procsFd=procsFd)
+
+
+# precomputed unshare(1) argument prefixes; the flag combinations never
+# change at runtime so there's no reason to rebuild them per call
+# We always provide --mount, because Assistent manager nor container mounting
+# should affect root namespace
+_UNSHARE_PREFIX_MOUNT = ("/usr/bin/unshare", "--mount")
+# If we want to execute in new pid namespace, unshare will need to fork
+# as it's not really easy to make a pid ns without starting a new process
+_UNSHARE_PREFIX_PID = _UNSHARE_PREFIX_MOUNT + ("--pid", "--fork", "--mount-proc")
+# we likely want a container process to be isolated from the root namespace
+# so isolate more resources
+_UNSHARE_PREFIX_CONTAINER = _UNSHARE_PREFIX_PID + ("--ipc", "--uts", "--cgroup")
 
 
 def generateUnshareCommand(
@@ -89,19 +283,11 @@ def generateUnshareCommand(
     This command can be used as a shim to move the invoking processes in to
     new namespaces.
     This is valuable when access to clone(2) is not easy
-
-    We always provide --mount, because Assistent manager nor container mounting
-    should affect root namespace
     """
-
-    command = ["/usr/bin/unshare", "--mount"]
-    if usePidNs or isContainer:
-        # If want to execute in new pid namespace, unshare will need to fork
-        # as it's not really easy to make a pid ns without starting a new process
-        command.extend(["--pid", "--fork", "--mount-proc"])
     if isContainer:
-        # we likely want this new process to be isolated from the root namespace
-        # so isolate more resources
-        command.extend(["--ipc", "--uts", "--cgroup"])
-    command.extend(cmd)
-    return command
+        prefix = _UNSHARE_PREFIX_CONTAINER
+    elif usePidNs:
+        prefix = _UNSHARE_PREFIX_PID
+    else:
+        prefix = _UNSHARE_PREFIX_MOUNT
+    return [*prefix, *cmd]
@@ -1,16 +1,14 @@
 #!/usr/bin/env python3
 
+import errno
 import os
-import shutil
+import select
 import signal
-import sys
+import time
 
-sys.path.append("gen-py")
+import _bootstrap
 
-from time import sleep
-
-from container_manager import ContainerManager
-from client_utils import thriftClient, waitForServer
+from client_utils import PersistentThriftClient, waitForServer
 from container_utils import recursivelyDeleteCgroups, generateUnshareCommand
 
 
@@ -40,125 +38,189 @@ class Executor:
     of the container and chroot-pivot-root in to it (unshare supports this)
     """
 
-    def __init__(self, port: int, cgPath: str, amBinPath: str):
+    def __init__(self, port: int, cgPath: str, amBinPath: str, readyFd: int = None):
         # port to make thrift requests to
         self.port = port
         # path to the assistent container manager binary
         self.amBinPath = amBinPath
         # assistents forked key is pid of assistent, value is tag of assistent
         self.children = {}
+        # pidfds of forked assistents, key is pidfd, value is pid
+        self.childFds = {}
+        # multiplex all assistent pidfds so a single poll watches every child
+        self.epoll = select.epoll()
+        # python has no signalfd(2) binding, so emulate it with the classic
+        # self-pipe trick: SIGCHLD writes a byte to the pipe, the read end
+        # sits in our epoll set, and the epoll wait wakes immediately even
+        # for children we could not obtain a pidfd for
+        self._sigR, self._sigW = os.pipe2(os.O_NONBLOCK | os.O_CLOEXEC)
+        signal.set_wakeup_fd(self._sigW)
+        # a (no-op) handler must be installed for SIGCHLD to be delivered
+        signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+        self.epoll.register(self._sigR, select.EPOLLIN)
         # path of container cgroup slice
         self.cgroupParentPath = cgPath
+        # precomputed "{slice}/" prefix; tag paths are built with plain
+        # concatenation in the start/reap paths rather than os.path.join
+        self._parentPrefix = self.cgroupParentPath.rstrip("/") + "/"
         # make initial parent dir, we'd like to fail early if there's an issue here
         os.makedirs(self.cgroupParentPath, mode=0o755, exist_ok=True)
         # wait until the server is up and ready before proceeding
-        waitForServer(port)
+        if readyFd is not None:
+            # one blocking read on the readiness pipe; the server writes a
+            # byte as soon as its socket is listening
+            os.read(readyFd, 1)
+            os.close(readyFd)
+        else:
+            # standalone invocation; fall back to probing the port
+            waitForServer(port)
+        # long-lived client for the per-tick queue poll; reconnects lazily
+        # if the server goes away
+        self._client = PersistentThriftClient(port)
+
+    # how long a dequeue may block server side waiting for runnable work;
+    # bounded so the tick still services zombie reaping regularly
+    DEQUEUE_TIMEOUT_MS = 1000
 
     def _getContainers(self):
         """
-        A consequence of a single threaded thrift server is that it can only
-        maintain a single client connection at a time requiring this costly
-        overhead per thrift call
+        Drain the server's runnable queue over our persistent connection
+        instead of paying a TCP connect/teardown on every tick
+
+        The long-poll timeout means the server holds the call until a
+        container becomes runnable, so a startContainer is picked up
+        immediately instead of on the next 1 second tick
         """
-        with thriftClient(self.port) as client:
-            response = client.dequeueReadyContainers()
+        with self._client as client:
+            response = client.dequeueReadyContainers(self.DEQUEUE_TIMEOUT_MS)
         return response.tags
 
     def _execAssistentManager(self, tag: str):
-        def waitForParent(readEnd, writeEnd, ctag):
-            # close write end of pipe since we don't need it
-            os.close(writeEnd)
-            # convert the fd to a file object
-            readEnd = os.fdopen(readEnd)
-            # wait on the parent via a blocking read call
-            msg = readEnd.read()
-            # close the read end of the pipe
-            readEnd.close()
-
-        def prepareChild(cpid, cgPath, ctag):
-            """
-            Set up cgroups, resource restrictions, etc for the assistent manager
-            """
-            # parent creates container cgroup "/{cgPath}/{ctag}"
-            dirName = os.path.join(cgPath, ctag)
-            os.makedirs(dirName, mode=0o755)
-            # move child to that cgroup
-            filename = os.path.join(dirName, "cgroup.procs")
-            with open(filename, "w") as f:
-                f.write(str(pid))
-
-        # set up pipes to be used for synchronization between executor and
-        # assistent manager
-        r, w = os.pipe()
-        # fork process
-        # under a better implementation we would be using clone(2) to create the process
-        # in its destination cgroup
-        # but in python it's non trivial to use clone(2) system call, so we use unshare(1)
-        pid = os.fork()
-        if pid == 0:
-            # This is the child process
-            waitForParent(r, w, tag)
-            # exec assistent manager in a new mount ns
-            cmd = generateUnshareCommand(
-                [self.amBinPath, str(self.port), tag, self.cgroupParentPath]
-            )
-            os.execv(cmd[0], cmd)
-            # if we reach here something bad happened
-            sys.exit(1)
-        else:
-            # parent closes the read end of the pipe
-            os.close(r)
-            # should not be possible
-            assert pid not in self.children
-            # track cpid and its assistent manager tag
-            self.children[pid] = tag
-            prepareChild(pid, self.cgroupParentPath, tag)
-            # parent writes to the pipe
-            os.write(w, b"1")
-            os.close(w)
-            print(f"Executor: Started assistent manager with tag '{tag}'")
-
-    def _handleZombies(self):
+        # create container cgroup "/{cgPath}/{ctag}" before spawning so the
+        # assistent can join it on its own, with no parent/child synchronization
+        dirName = self._parentPrefix + tag
+        os.makedirs(dirName, mode=0o755)
+        # spawn the assistent manager in a new mount ns. posix_spawn rides
+        # vfork+exec under the hood, so starting an assistent doesn't copy
+        # the executor's page tables the way fork does. The assistent
+        # writes itself in to the container cgroup on startup (it knows the
+        # parent cgroup path and its tag from argv), since spawn file
+        # actions can't write a pid that doesn't exist yet
+        cmd = generateUnshareCommand(
+            [self.amBinPath, str(self.port), tag, self.cgroupParentPath]
+        )
+        pid = os.posix_spawn(cmd[0], cmd, os.environ)
+        # should not be possible
+        assert pid not in self.children
+        # track cpid and its assistent manager tag
+        self.children[pid] = tag
+        try:
+            # grab a pidfd so the child's death can be waited on via epoll
+            # requires python 3.9+ and linux 5.3+
+            fd = os.pidfd_open(pid, 0)
+            self.epoll.register(fd, select.EPOLLIN)
+            self.childFds[fd] = pid
+        except (AttributeError, OSError):
+            # fall back to the periodic non-blocking waitpid check
+            pass
+        print(f"Executor: Started assistent manager with tag '{tag}'")
+
+    def _reapChild(self, cpid: int, status: int):
+        """
+        Record the exit information of a dead assistent manager and clean up
+        the empty cgroup(s) it was using
+        """
+        # non-negative status values means it exited via _exit(2) and returns the int value
+        # negative status values mean it was killed by a signal and returns the signal number
+        print(
+            f"Executor: Assistent Manager Process {cpid} associated with "
+            f"tag '{self.children[cpid]}' died with status "
+            f"{os.waitstatus_to_exitcode(status)}"
+        )
+        # recursively clean up cgroup "/{cgPath}/{ctag}"
+        dirName = self._parentPrefix + self.children[cpid]
+        self._removeCgroup(dirName)
+        del self.children[cpid]
+
+    def _removeCgroup(self, dirName: str):
+        """
+        Remove a dead assistent's cgroup tree, retrying briefly when the
+        kernel still reports it busy/non-empty. The assistent is reaped
+        the instant it dies, which can race the kernel releasing the last
+        members of its cgroup; without the retry that race would take the
+        whole reaper down
+        """
+        for _ in range(5):
+            try:
+                recursivelyDeleteCgroups(dirName)
+                return
+            except OSError as e:
+                if e.errno not in (errno.ENOTEMPTY, errno.EBUSY):
+                    raise
+                time.sleep(0.01)
+        # let the final attempt raise if the cgroup is truly wedged
+        recursivelyDeleteCgroups(dirName)
+
+    def _handleZombies(self, timeout: float):
         """
         If there is a zombie child, we need to call one of the wait() family
         of system calls to reap the zombie.
 
-        This also provides us the exit information of the assistent manager
-        that could be useful for debugging.
-
-        We also take this chance to clean up the empty cgroup(s) it was using.
+        When pidfds are available we block on epoll until a child actually
+        dies (or the timeout expires), so each zombie is reaped as soon as it
+        appears rather than on the next polling tick.
         see waitpid(2) NOTES for details on zombies
         """
-        cpid, status = os.waitpid(-1, os.WNOHANG)
-        if cpid:
-            # non-negative status values means it exited via _exit(2) and returns the int value
-            # negative status values mean it was killed by a signal and returns the signal number
-            print(
-                f"Executor: Assistent Manager Process {cpid} associated with "
-                f"tag '{self.children[cpid]}' died with status "
-                f"{os.waitstatus_to_exitcode(status)}"
-            )
-            # recursively clean up cgroup "/{cgPath}/{ctag}"
-            dirName = os.path.join(self.cgroupParentPath, self.children[cpid])
-            recursivelyDeleteCgroups(dirName)
-            del self.children[cpid]
+        # with no children registered this degrades to a plain sleep, so
+        # the epoll wait doubles as the loop tick
+        for fd, _ in self.epoll.poll(timeout):
+            if fd == self._sigR:
+                # SIGCHLD fired; drain the wakeup byte(s) and reap any
+                # children that have no pidfd in the epoll set
+                try:
+                    os.read(self._sigR, 512)
+                except BlockingIOError:
+                    pass
+                self._reapUntrackedChildren()
+                continue
+            cpid = self.childFds[fd]
+            # the pidfd is readable, so this wait will not block
+            _, status = os.waitpid(cpid, 0)
+            self._reapChild(cpid, status)
+            self.epoll.unregister(fd)
+            os.close(fd)
+            del self.childFds[fd]
+
+    def _reapUntrackedChildren(self):
+        """
+        Reap every already dead child that lacks a pidfd registration
+        We deliberately avoid waitpid(-1) here, which could steal the zombie
+        of a pidfd-tracked child out from under its epoll event
+        """
+        tracked = set(self.childFds.values())
+        for cpid in [p for p in self.children if p not in tracked]:
+            pid, status = os.waitpid(cpid, os.WNOHANG)
+            if pid:
+                self._reapChild(pid, status)
 
     def driveState(self):
         """
         Check if any containers are ready to be executed
         Clean up any already exited containers
         Perform any other cleanup / responsibilities our server can't do
+
+        The loop's main blocking point is the server-side long poll in
+        _getContainers, so new work is dispatched as soon as it's enqueued.
+        Child deaths raise pidfd events that stay readable until reaped, so
+        a short epoll wait after each dequeue is enough to pick them up
         """
         while True:
-            # check for runnable containers to start
+            # check for runnable containers to start; blocks server side
+            # until containers are runnable or the long poll times out
             tags = self._getContainers()
             # for each container, fork and exec an Assistent Manager
             for tag in tags:
                 self._execAssistentManager(tag)
 
-            # check if any assistent managers died
-            if self.children:
-                self._handleZombies()
-
-            # sleep for 1 second
-            sleep(1)
+            # reap any children that died while we were long polling
+            self._handleZombies(0.1)
@@ -2,30 +2,34 @@
 
 import os
 import signal
-import sys
 
-sys.path.append("gen-py")
+import _bootstrap
 
-from client_utils import thriftClient, containerInState, waitFor
+from client_utils import PersistentThriftClient
 from container_utils import sendSignalToCgroup
 
 from container_manager.ttypes import (
     AssistentManagerStatusRequest,
     Command,
+    ContainerOp,
     ContainerState,
     CreateContainerRequest,
     DeleteContainerRequest,
     StartContainerRequest,
     StopContainerRequest,
+    SubmitContainerOpsRequest,
+    WaitForStateRequest,
 )
 
-""" 
-NOTE: we re-create client every call because we have a single threaded
-thrift server for this toy project and our user API and internal API
-are handled by the same thrift handler, meaning only one entity can
-connect at a time, but there are usually three entities invovled in the 
-life cycle of a container in our design
 """
+NOTE: one persistent client serves every call in these lifecycles; the
+connect/teardown per request only ever existed to share the single
+threaded server between the user API and the internal API, which a
+concurrent server makes unnecessary
+"""
+
+# shared across all lifecycle functions; reconnects lazily if needed
+_client = PersistentThriftClient(9090)
 
 
 def containerLifeCycle1():
@@ -34,34 +38,44 @@ def containerLifeCycle1():
     """
     print("***Starting user controlled lifecycle!***")
     tag = "container_id_1"
-    print(f"creating container '{tag}'!")
-    with thriftClient(9090) as client:
-        request = CreateContainerRequest(tag)
-        client.createContainer(request)
-
-    print(f"starting container '{tag}'!")
-    with thriftClient(9090) as client:
-        request = StartContainerRequest()
-        request.tag = tag
-        request.command = Command(
+    print(f"creating and starting container '{tag}'!")
+    with _client as client:
+        start = StartContainerRequest()
+        start.tag = tag
+        start.command = Command(
             "/bin/perl", ["-e", "use sigtrap qw(die normal-signals); sleep"]
         )
-        client.startContainer(request)
+        # create+start in one round trip
+        client.submitContainerOps(
+            SubmitContainerOpsRequest(
+                [
+                    ContainerOp(create=CreateContainerRequest(tag)),
+                    ContainerOp(start=start),
+                ]
+            )
+        )
 
-    # wait a little for the container to reach running
-    assert waitFor(containerInState, 9090, tag, ContainerState.RUNNING, timeout=5)
+        # block server side until the container reaches running
+        response = client.waitForContainerState(
+            WaitForStateRequest(tag, ContainerState.RUNNING, 5000)
+        )
+        assert response.reached
 
     print(f"stopping container '{tag}'!")
-    with thriftClient(9090) as client:
+    with _client as client:
         request = StopContainerRequest(tag)
         client.stopContainer(request)
 
-    # wait a little for container to reach DEAD
-    assert waitFor(containerInState, 9090, tag, ContainerState.DEAD, timeout=5)
+    # block server side until the container reaches DEAD
+    with _client as client:
+        response = client.waitForContainerState(
+            WaitForStateRequest(tag, ContainerState.DEAD, 5000)
+        )
+        assert response.reached
 
     print(f"deleting container '{tag}'!")
 
-    with thriftClient(9090) as client:
+    with _client as client:
         request = DeleteContainerRequest(tag)
         client.deleteContainer(request)
 
@@ -72,38 +86,57 @@ def containerLifeCycle2():
     """
     print("***Starting signal controlled lifecycle!***")
     tag = "container_id_2"
-    print(f"creating container '{tag}'!")
-    with thriftClient(9090) as client:
-        request = CreateContainerRequest(tag)
-        client.createContainer(request)
-
-    print(f"starting container '{tag}'!")
-    with thriftClient(9090) as client:
-        request = StartContainerRequest()
-        request.tag = tag
-        request.command = Command(
+    print(f"creating and starting container '{tag}'!")
+    with _client as client:
+        start = StartContainerRequest()
+        start.tag = tag
+        start.command = Command(
             "/bin/perl", ["-e", "use sigtrap qw(die normal-signals); sleep"]
         )
-        client.startContainer(request)
+        # create+start in one round trip
+        client.submitContainerOps(
+            SubmitContainerOpsRequest(
+                [
+                    ContainerOp(create=CreateContainerRequest(tag)),
+                    ContainerOp(start=start),
+                ]
+            )
+        )
 
-    # wait a little for the container to reach running
-    assert waitFor(containerInState, 9090, tag, ContainerState.RUNNING, timeout=5)
+        # block server side until the container reaches running
+        response = client.waitForContainerState(
+            WaitForStateRequest(tag, ContainerState.RUNNING, 5000)
+        )
+        assert response.reached
 
     print(f"injecting a failure in to container '{tag}'!")
-    with thriftClient(9090) as client:
+    with _client as client:
         request = AssistentManagerStatusRequest(tag)
         response = client.getAssistentManagerStatus(request)
         info = response.amInfo
-        # ignore sending signal to assistent manager, we need it to report the child exit
-        # and kill everything else
-        sendSignalToCgroup(info.cgroupPath, signal.SIGTERM, [info.pid])
-
-    # wait a little for container to reach DEAD
-    assert waitFor(containerInState, 9090, tag, ContainerState.DEAD, timeout=5)
+        # the server-side RUNNING wait returns within milliseconds of the
+        # assistent's first report, which can beat the workload to its
+        # exec and sigtrap setup; and as pid 1 of its pid namespace the
+        # workload silently discards signals it has no handler for yet.
+        # So resend the SIGTERM until the container actually dies instead
+        # of trusting one shot to land
+        reached = False
+        for _ in range(10):
+            # ignore sending signal to assistent manager, we need it to report
+            # the child exit and kill everything else
+            sendSignalToCgroup(info.cgroupPath, signal.SIGTERM, [info.pid])
+            # block server side until the container reaches DEAD
+            response = client.waitForContainerState(
+                WaitForStateRequest(tag, ContainerState.DEAD, 1000)
+            )
+            if response.reached:
+                reached = True
+                break
+        assert reached
 
     print(f"deleting container '{tag}'!")
 
-    with thriftClient(9090) as client:
+    with _client as client:
         request = DeleteContainerRequest(tag)
         client.deleteContainer(request)
 
@@ -114,27 +147,34 @@ def containerLifeCycle3():
     """
     print("***Starting natural lifecycle!***")
     tag = "container_id_3"
-    print(f"creating container '{tag}'!")
-    with thriftClient(9090) as client:
-        request = CreateContainerRequest(tag)
-        client.createContainer(request)
-
-    print(f"starting container '{tag}'!")
-    with thriftClient(9090) as client:
-        request = StartContainerRequest()
-        request.tag = tag
+    print(f"creating and starting container '{tag}'!")
+    with _client as client:
+        start = StartContainerRequest()
+        start.tag = tag
         # short lived command so container exits naturally
-        request.command = Command(
+        start.command = Command(
             "/bin/perl", ["-e", "use sigtrap qw(die normal-signals); sleep 3"]
         )
-        client.startContainer(request)
+        # create+start in one round trip
+        client.submitContainerOps(
+            SubmitContainerOpsRequest(
+                [
+                    ContainerOp(create=CreateContainerRequest(tag)),
+                    ContainerOp(start=start),
+                ]
+            )
+        )
 
-    # wait a little for container to reach DEAD
-    assert waitFor(containerInState, 9090, tag, ContainerState.DEAD, timeout=5)
+    # block server side until the container reaches DEAD
+    with _client as client:
+        response = client.waitForContainerState(
+            WaitForStateRequest(tag, ContainerState.DEAD, 5000)
+        )
+        assert response.reached
 
     print(f"deleting container '{tag}'!")
 
-    with thriftClient(9090) as client:
+    with _client as client:
         request = DeleteContainerRequest(tag)
         client.deleteContainer(request)
 
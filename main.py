@@ -5,31 +5,29 @@ import os
 import signal
 import sys
 
-sys.path.append("gen-py")
+import _bootstrap
 
-from functools import partial
 from container_manager import ContainerManager
 from manager import ContainerManagerHandler
 from executor import Executor
 
 from thrift.transport import TSocket
-from thrift.transport import TTransport
-from thrift.protocol import TBinaryProtocol
-from thrift.server import TServer
-
-
-def signalHandler(signum, frame, pid):
-    os.kill(pid, signal.SIGKILL)
-    # best effort reaping of child process, worst case child will be
-    # reparented and reaped by init
-    os.waitpid(pid, 0)
-    print(f"Received signal {signum}! Exiting!")
-    sys.exit(0)
+from thrift.protocol import TCompactProtocol
+from thrift.server import TNonblockingServer
 
 
 def registerSignalHandler(pid):
-    global signalHandler
-    signalHandler = partial(signalHandler, pid=pid)
+    # a closure over the executor pid; no partial/global rebinding layer
+    # in the handler's call path. The signal interrupts the server's
+    # select with EINTR, so shutdown doesn't wait on the next connection
+    def signalHandler(signum, frame):
+        os.kill(pid, signal.SIGKILL)
+        # best effort reaping of child process, worst case child will be
+        # reparented and reaped by init
+        os.waitpid(pid, 0)
+        print(f"Received signal {signum}! Exiting!")
+        sys.exit(0)
+
     signal.signal(signal.SIGTERM, signalHandler)
     signal.signal(signal.SIGINT, signalHandler)
 
@@ -58,26 +56,57 @@ if __name__ == "__main__":
     )
     args = parser.parse_args()
 
+    readyW = None
     if not args.no_executor:
         print("CManager: Spawning Executor process")
+        # readiness pipe: the server writes one byte once it's listening so
+        # the executor can block on a single read instead of retrying
+        # thrift connects on a timer. CLOEXEC so neither end can leak in
+        # to processes spawned later (fork keeps both ends for us)
+        readyR, readyW = os.pipe2(os.O_CLOEXEC)
         pid = os.fork()
         if pid == 0:
             # child should invoke executor function (and not return)
-            Executor(args.port, args.parent_cgroup, args.assistent_manager_bin).driveState()
+            os.close(readyW)
+            Executor(
+                args.port,
+                args.parent_cgroup,
+                args.assistent_manager_bin,
+                readyFd=readyR,
+            ).driveState()
             # if we reached here something bad happened
             sys.exit(1)
         else:
+            os.close(readyR)
             # set up signal handler to kill executor along side the main process
             registerSignalHandler(pid)
 
     # set up thrift server
     handler = ContainerManagerHandler()
     processor = ContainerManager.Processor(handler)
+    # framed transport writes one send per message and compact protocol
+    # shrinks the payloads via varint encoding; both sides must match
     transport = TSocket.TServerSocket(host="127.0.0.1", port=args.port)
-    tfactory = TTransport.TBufferedTransportFactory()
-    pfactory = TBinaryProtocol.TBinaryProtocolFactory()
+    if readyW is not None:
+        # announce readiness on the pipe the moment the socket is listening
+        origListen = transport.listen
 
-    server = TServer.TSimpleServer(processor, transport, tfactory, pfactory)
+        def listenAndSignal(w=readyW):
+            origListen()
+            os.write(w, b"1")
+            os.close(w)
+
+        transport.listen = listenAndSignal
+    pfactory = TCompactProtocol.TCompactProtocolFactory()
+
+    # nonblocking server multiplexes every connection, so the executor,
+    # the assistent managers, and cli users each hold a persistent
+    # connection instead of contending for one accept slot; it implies
+    # framed transport, matching the clients. Handler state stays safe via
+    # the per-method lock in ContainerManagerHandler
+    server = TNonblockingServer.TNonblockingServer(
+        processor, transport, inputProtocolFactory=pfactory
+    )
 
     print(f"CManager: Container Manager starting on port {args.port}...")
     server.serve()
@@ -1,7 +1,10 @@
 #!/usr/bin/env python3
-import sys
+import collections
+import copy
+import functools
+import threading
 
-sys.path.append("gen-py")
+import _bootstrap
 
 from typing import List
 
@@ -17,6 +20,9 @@ from container_manager.ttypes import (
     DeleteContainerRequest,
     ListContainerRequest,
     ListContainerResponse,
+    SubmitContainerOpsRequest,
+    WaitForStateRequest,
+    WaitForStateResponse,
     ReportContainerStatusRequest,
     ReportContainerStatusResponse,
     AssistentManagerStatusResponse,
@@ -25,6 +31,33 @@ from container_manager.ttypes import (
 )
 
 
+# the three report responses carry nothing but the manager's verdict, so
+# build each once and reuse it; thrift only reads the struct when
+# serializing a response, it never mutates it
+_RESP_OKAY = ReportContainerStatusResponse(ManagerResponse.OKAY)
+_RESP_STOP = ReportContainerStatusResponse(ManagerResponse.STOP)
+_RESP_ABORT = ReportContainerStatusResponse(ManagerResponse.ABORT)
+
+
+def _locked(method):
+    """
+    Serialize a handler method under the handler's lock
+
+    The server now services clients concurrently, so every method runs
+    under one (reentrant) lock to preserve the single threaded state
+    management semantics the handler was written with. Blocking calls
+    (the long-poll dequeue and waitForContainerState) wait on conditions
+    built over the same lock, so they release it while they sleep
+    """
+
+    @functools.wraps(method)
+    def wrapper(self, *args):
+        with self._lock:
+            return method(self, *args)
+
+    return wrapper
+
+
 class ContainerManagerHandler:
     """
     API Handler of the container manager thrift service
@@ -35,9 +68,10 @@ class ContainerManagerHandler:
     A cli user/scheduler will use create/start/list/stop/delete calls
     The assistent container manager will only use get/report status calls
 
-    An assumption at the moment is that the thrift server is a single threaded
-    server thus avoiding many complex state management issues that one would see
-    in a real implementation
+    The server accepts clients concurrently, but every handler method runs
+    under a single reentrant lock (see _locked), which keeps the simple
+    single threaded state management this handler was written with while
+    letting independent callers hold their own connections
 
     Additionally we are leaving all process killing/management up to the assistent
     container manager. This is problematic due to the many non-user induced events
@@ -63,9 +97,17 @@ class ContainerManagerHandler:
         self.assistentManagers = {}
         # the executor process will pull from this queue and start
         # assistent managers (which then start the containers)
-        self.runnable = []
-        # active container accounting
-        self.runningContainers = set()
+        # a deque so the dequeue drains it by swapping in a fresh one
+        self.runnable = collections.deque()
+        # one lock guards all handler state; the conditions share it.
+        # reentrant because batched ops call the individual locked methods
+        self._lock = threading.RLock()
+        # signalled whenever a container changes state so waiters don't
+        # have to sleep-poll listContainers
+        self._stateCond = threading.Condition(self._lock)
+        # signalled when a container is enqueued as runnable so the
+        # executor's dequeue can long-poll instead of ticking on a timer
+        self._runnableCond = threading.Condition(self._lock)
 
     def _tag_exists(self, tag: str):
         return tag in self.containerInfos
@@ -78,14 +120,15 @@ class ContainerManagerHandler:
         if not self._tag_exists(tag):
             raise InvalidOperation(f"container: {tag} does not exist")
 
-    def _checkInStates(self, tag: str, states: List[ContainerState]):
-        if self.containerInfos[tag].state not in states:
+    def _checkInStates(self, info: ContainerInfo, states: List[ContainerState]):
+        if info.state not in states:
             raise InvalidOperation(
-                f"container: {tag} state mismatch: Expected {states}, Actual {self.containerInfos[tag].state}"
+                f"container: {info.tag} state mismatch: Expected {states}, Actual {info.state}"
             )
 
     """ API for cli user / scheduler """
 
+    @_locked
     def createContainer(self, request: CreateContainerRequest):
         """
         Public:
@@ -104,6 +147,7 @@ class ContainerManagerHandler:
             request.tag, ContainerState.READY
         )
 
+    @_locked
     def startContainer(self, request: StartContainerRequest):
         """
         Public:
@@ -117,14 +161,13 @@ class ContainerManagerHandler:
         transitioned to running.
 
         Internal Notes:
-        A consequence of our single threaded server handling both user APIs and
-        executor/assistent APIs setup is that our server can't respond to an
-        executor/assistent thrift call if the server is stuck waiting on this
-        thrift call to complete, so we go with an asynchronous model of work deferral
+        Actually starting a container means forking processes and touching
+        cgroups, which has no business happening under the handler lock,
+        so we keep the asynchronous model of work deferral to the executor
         """
         # container info must exist and be ready
         self._checkExists(request.tag)
-        self._checkInStates(request.tag, [ContainerState.READY])
+        self._checkInStates(self.containerInfos[request.tag], [ContainerState.READY])
         # if an assistent manager exists, then start was already called
         if request.tag in self.assistentManagers:
             raise InvalidOperation(f"container: {request.tag} is already starting")
@@ -132,9 +175,12 @@ class ContainerManagerHandler:
         self.assistentManagers[request.tag] = AssistentManagerInfo(
             request.tag, request.command
         )
-        # enqueue on runnable queue for executor to grab
+        # enqueue on runnable queue for executor to grab and wake any
+        # long-polling dequeue (the handler lock is already held)
         self.runnable.append(request.tag)
+        self._runnableCond.notify_all()
 
+    @_locked
     def stopContainer(self, request: StopContainerRequest):
         """
         Public:
@@ -154,12 +200,12 @@ class ContainerManagerHandler:
         """
         # container info must exist and be running (and thus have an assistent manager)
         self._checkExists(request.tag)
-        self._checkInStates(
-            request.tag, [ContainerState.STOPPING, ContainerState.RUNNING]
-        )
+        ci = self.containerInfos[request.tag]
+        self._checkInStates(ci, [ContainerState.STOPPING, ContainerState.RUNNING])
         # mark the container in stopping state
-        self.containerInfos[request.tag].state = ContainerState.STOPPING
+        ci.state = ContainerState.STOPPING
 
+    @_locked
     def deleteContainer(self, request: DeleteContainerRequest):
         """
         Public:
@@ -179,34 +225,122 @@ class ContainerManagerHandler:
         if request.tag in self.assistentManagers:
             del self.assistentManagers[request.tag]
 
+    @_locked
     def listContainers(self, request: ListContainerRequest) -> ListContainerResponse:
         """
         If tags is None or length 0, return all container infos
         otherwise return container infos corresponding to tags
+
+        The worker serializes the response after the handler lock is
+        released, so these must be snapshot copies: handing thrift the
+        live dict view or the live info structs would race with another
+        worker mutating them mid-serialization
         """
         if not request.tags or len(request.tags) < 1:
-            return ListContainerResponse(self.containerInfos.values())
-        for tag in request.tags:
-            self._checkExists(tag)
-        return ListContainerResponse([self.containerInfos[tag] for tag in request.tags])
+            return ListContainerResponse(
+                [copy.copy(ci) for ci in self.containerInfos.values()]
+            )
+        try:
+            # one dict lookup per tag; the KeyError tells us which tag
+            # missed without a separate existence pass
+            return ListContainerResponse(
+                [copy.copy(self.containerInfos[tag]) for tag in request.tags]
+            )
+        except KeyError as e:
+            raise InvalidOperation(f"container: {e.args[0]} does not exist")
+
+    @_locked
+    def waitForContainerState(
+        self, request: WaitForStateRequest
+    ) -> WaitForStateResponse:
+        """
+        Public:
+        Block until the given container reaches the desired state or the
+        timeout expires. One round trip replaces a listContainers poll loop
+
+        State transitions:
+        None; this is purely an observation call
+
+        Internal Notes:
+        Waiting on the condition releases the handler lock, so status
+        reports (which drive the transitions) flow while we sleep
+        """
+        self._checkExists(request.tag)
+
+        def _reached():
+            info = self.containerInfos.get(request.tag)
+            return info is not None and info.state == request.state
+
+        reached = self._stateCond.wait_for(_reached, timeout=request.timeoutMs / 1000.0)
+        return WaitForStateResponse(reached)
+
+    @_locked
+    def submitContainerOps(self, request: SubmitContainerOpsRequest):
+        """
+        Public:
+        Apply a batch of container operations in their declared order
+        A client can coalesce e.g create+start (or stop+delete) in to a
+        single round trip instead of one request per operation
+
+        State transitions:
+        Whatever the individual operations would do
+
+        Internal Notes:
+        Operations are applied in order until the first failure; any ops
+        already applied are not rolled back, matching what the caller
+        would get issuing the same requests one at a time
+        """
+        for op in request.ops:
+            if op.create is not None:
+                self.createContainer(op.create)
+            elif op.start is not None:
+                self.startContainer(op.start)
+            elif op.stop is not None:
+                self.stopContainer(op.stop)
+            elif op.erase is not None:
+                self.deleteContainer(op.erase)
+            else:
+                raise InvalidOperation("empty container op in batch")
 
     """ API for executor and assistent manager """
 
-    def dequeueReadyContainers(self) -> List[str]:
+    @_locked
+    def dequeueReadyContainers(self, timeoutMs: int = 0) -> List[str]:
         """
         Return all the ready container tags and clear the runnable queue.
         This is expected to be called by the executor only
+
+        With a non-zero timeoutMs and an empty queue, block until a
+        container becomes runnable or the timeout expires. That turns the
+        executor's fixed 1 second tick in to an event driven wakeup: a
+        startContainer call releases the long poll immediately
         """
-        elements = self.runnable[:]
-        self.runnable.clear()
-        return ContainerIdResponse(elements)
+        if not self.runnable and timeoutMs > 0:
+            self._runnableCond.wait_for(
+                lambda: len(self.runnable) > 0, timeout=timeoutMs / 1000.0
+            )
+        # O(1) hand-off: swap the whole queue out instead of copy+clear
+        elements, self.runnable = self.runnable, collections.deque()
+        return ContainerIdResponse(list(elements))
 
+    @_locked
     def getRunningContainers(self) -> List[str]:
         """
         Return all running container tags
+
+        Derived from containerInfos on demand; this call is rare next to
+        reportContainerStatus, so we'd rather scan here than maintain a
+        parallel set on every state transition
         """
-        return ContainerIdResponse(list(self.runningContainers))
+        return ContainerIdResponse(
+            [
+                tag
+                for tag, ci in self.containerInfos.items()
+                if ci.state == ContainerState.RUNNING
+            ]
+        )
 
+    @_locked
     def getAssistentManagerStatus(
         self, request: AssistentManagerStatusRequest
     ) -> AssistentManagerStatusResponse:
@@ -216,10 +350,14 @@ class ContainerManagerHandler:
         caller (a rogue assistent manager) should exit immediately
         """
         response = AssistentManagerStatusResponse()
-        if request.tag in self.assistentManagers:
-            response.amInfo = self.assistentManagers[request.tag]
+        amInfo = self.assistentManagers.get(request.tag)
+        if amInfo is not None:
+            # copy: serialization happens after the lock is released and
+            # reportContainerStatus mutates the live struct in place
+            response.amInfo = copy.copy(amInfo)
         return response
 
+    @_locked
     def reportContainerStatus(
         self, request: ReportContainerStatusRequest
     ) -> ReportContainerStatusResponse:
@@ -241,14 +379,14 @@ class ContainerManagerHandler:
         OR
         running -> dead
         """
-        if request.tag not in self.containerInfos:
+        # bind the info objects once; this is the highest frequency call
+        # in the handler and each subscript re-hashes the tag
+        ci = self.containerInfos.get(request.tag)
+        if ci is None:
             # this assistent manager is LOST/not managed and should be killed
-            return ReportContainerStatusResponse(ManagerResponse.ABORT)
+            return _RESP_ABORT
 
-        if (
-            request.state == ContainerState.RUNNING
-            and self.containerInfos[request.tag].state == ContainerState.READY
-        ):
+        if request.state == ContainerState.RUNNING and ci.state == ContainerState.READY:
             # transitioning from ready -> running
             # update assistent manager run time metadata info
             amInfo = self.assistentManagers[request.tag]
@@ -256,19 +394,29 @@ class ContainerManagerHandler:
             amInfo.workloadPid = request.workloadPid
             amInfo.cgroupPath = request.cgroupPath
             # update container info metadata
-            self.containerInfos[request.tag].state = ContainerState.RUNNING
-            self.runningContainers.add(request.tag)
+            ci.state = ContainerState.RUNNING
         elif request.state == ContainerState.DEAD:
             # transitioning from stopping/running -> dead
             # preserve assistent manager metadata as it's good for debugging
             # update container info metadata
-            self.containerInfos[request.tag].state = ContainerState.DEAD
-            self.containerInfos[request.tag].exitInfo = request.exitInfo
-            self.runningContainers.remove(request.tag)
+            ci.state = ContainerState.DEAD
+            ci.exitInfo = request.exitInfo
+
+        # wake up anybody blocked on a state transition
+        self._stateCond.notify_all()
 
         # tell assistent manager to stop the container if it was requested
-        if self.containerInfos[request.tag].state == ContainerState.STOPPING:
-            response = ReportContainerStatusResponse(ManagerResponse.STOP)
-        else:
-            response = ReportContainerStatusResponse(ManagerResponse.OKAY)
-        return response
+        if ci.state == ContainerState.STOPPING:
+            return _RESP_STOP
+        return _RESP_OKAY
+
+    @_locked
+    def reportContainerStatusBatch(
+        self, requests: List[ReportContainerStatusRequest]
+    ) -> List[ReportContainerStatusResponse]:
+        """
+        Apply several status reports in one round trip, returning the
+        manager's verdict for each in request order. A caller reporting
+        for many containers pays one RPC instead of one per container
+        """
+        return [self.reportContainerStatus(request) for request in requests]
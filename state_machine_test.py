@@ -1,18 +1,16 @@
 #!/usr/bin/env python3
 
-import random
 import unittest
 import subprocess
-import sys
 
-sys.path.append("gen-py")
+import _bootstrap
 
 from typing import Dict
 from thrift.transport import TSocket
 from thrift.transport import TTransport
-from thrift.protocol import TBinaryProtocol
+from thrift.protocol import TCompactProtocol
 
-from client_utils import waitForServer
+from client_utils import _tuneSocket, waitForServer
 from container_manager import ContainerManager
 from container_manager.ttypes import (
     ContainerState,
@@ -37,6 +35,11 @@ class TestServerAPI(unittest.TestCase):
     out of the gate framework for setup/assertions
     """
 
+    # the assistent and workload pids aren't that important for this test,
+    # so use fixed fakes rather than drawing randoms per report
+    _FAKE_PID = 1
+    _FAKE_WPID = 2
+
     @classmethod
     def setUpClass(cls):
         # start server with no executor on a port
@@ -48,11 +51,19 @@ class TestServerAPI(unittest.TestCase):
         waitForServer(port)
         # Make a client connection and re-use it across the class since
         # we are driving all the state manually
-        cls._transport = TSocket.TSocket("localhost", port)
-        cls._transport = TTransport.TBufferedTransport(cls._transport)
-        protocol = TBinaryProtocol.TBinaryProtocol(cls._transport)
+        tsocket = TSocket.TSocket("localhost", port)
+        cls._transport = TTransport.TFramedTransport(tsocket)
+        protocol = TCompactProtocol.TCompactProtocol(cls._transport)
         cls._client = ContainerManager.Client(protocol)
         cls._transport.open()
+        # no Nagle delays on our tiny frames, and keep-alive like the
+        # other clients
+        _tuneSocket(tsocket.handle)
+        # thrift structs are plain python objects, so a single report
+        # request can be mutated between calls instead of reallocated
+        cls._reportRequest = ReportContainerStatusRequest(
+            pid=cls._FAKE_PID, workloadPid=cls._FAKE_WPID
+        )
         return super().setUpClass()
 
     @classmethod
@@ -69,24 +80,38 @@ class TestServerAPI(unittest.TestCase):
         response = self._client.listContainers(request)
         self.assertIsNotNone(response)
         self.assertEqual(len(response.containerInfos), expectedSize)
+        # index once; also fails loudly if an expected tag is missing,
+        # which the old nested scan silently skipped
+        infoByTag = {info.tag: info for info in response.containerInfos}
         for ctag, expectedState in tags.items():
-            # find the container Info and check state
-            for info in response.containerInfos:
-                if ctag == info.tag:
-                    self.assertEqual(expectedState, info.state)
+            self.assertIn(ctag, infoByTag)
+            self.assertEqual(expectedState, infoByTag[ctag].state)
 
     def _checkAgentResponse(
         self, tag: str, state: ContainerState, expectedResponse: ManagerResponse
     ):
-        request = ReportContainerStatusRequest()
+        # reuse one request across checks; only tag and state vary
+        request = self._reportRequest
         request.tag = tag
         request.state = state
-        # the assistent and workload pid isn't that important for this test
-        request.pid = random.randint(0, 100)
-        request.workloadPid = random.randint(100, 200)
         response = self._client.reportContainerStatus(request)
         self.assertEqual(response.status, expectedResponse)
 
+    def _checkAgentResponses(self, reports):
+        # pipeline several (tag, state, expected) reports in one batched
+        # round trip; distinct request objects since the batch is
+        # serialized as a whole
+        requests = [
+            ReportContainerStatusRequest(
+                tag=tag, state=state, pid=self._FAKE_PID, workloadPid=self._FAKE_WPID
+            )
+            for tag, state, _ in reports
+        ]
+        responses = self._client.reportContainerStatusBatch(requests)
+        self.assertEqual(len(responses), len(reports))
+        for (_, _, expectedResponse), response in zip(reports, responses):
+            self.assertEqual(response.status, expectedResponse)
+
     def testStateMachine(self):
         # empty state should return no container infos
         self._checkContainerInfos({}, 0)
@@ -94,9 +119,10 @@ class TestServerAPI(unittest.TestCase):
         # create container tests
 
         ctags = ["one", "two"]
-        # try unique requests
+        # try unique requests; one request object, rebinding the tag
+        request = CreateContainerRequest()
         for tag in ctags:
-            request = CreateContainerRequest(tag)
+            request.tag = tag
             self._client.createContainer(request)
 
         # test duplicate creation fails
@@ -106,9 +132,10 @@ class TestServerAPI(unittest.TestCase):
         # should have two container infos in the system
         self._checkContainerInfos({}, len(ctags))
 
-        # start ready containers
+        # start ready containers; again one request object across the loop
+        request = StartContainerRequest(command=Command("/bin/echo", ["howdy"]))
         for tag in ctags:
-            request = StartContainerRequest(tag, Command("/bin/echo", ["howdy"]))
+            request.tag = tag
             self._client.startContainer(request)
 
         # test duplicate start fails
@@ -129,12 +156,12 @@ class TestServerAPI(unittest.TestCase):
         # drive their state to running manually
         # it's normally done by the executor and assistent manager
 
-        # should be two containers in ready state
-        response = self._client.dequeueReadyContainers()
+        # should be two containers in ready state (no long poll needed)
+        response = self._client.dequeueReadyContainers(0)
         self.assertEqual(len(response.tags), len(ctags))
 
         # should be empty from the previous call
-        response = self._client.dequeueReadyContainers()
+        response = self._client.dequeueReadyContainers(0)
         self.assertEqual(len(response.tags), 0)
 
         # if unknown container reporting in, should ask it to ABORT
@@ -142,18 +169,15 @@ class TestServerAPI(unittest.TestCase):
             "unknown", ContainerState.RUNNING, ManagerResponse.ABORT
         )
 
-        # transition container one from READY to RUNNING
-        self._checkAgentResponse("one", ContainerState.RUNNING, ManagerResponse.OKAY)
-
-        # should be one running container
-        response = self._client.getRunningContainers()
-        self.assertEqual(len(response.tags), 1)
-
-        # transition container one to DEAD state
-        self._checkAgentResponse("one", ContainerState.DEAD, ManagerResponse.OKAY)
-
-        # should also be dead now
-        self._checkContainerInfos({"one": ContainerState.DEAD}, 1)
+        # drive container one READY -> RUNNING -> DEAD with one pipelined
+        # batch; the manager applies and answers the reports in order
+        self._checkAgentResponses(
+            [
+                ("one", ContainerState.RUNNING, ManagerResponse.OKAY),
+                ("one", ContainerState.DEAD, ManagerResponse.OKAY),
+            ]
+        )
+        # ("one"'s DEAD state is asserted in the next batched info check)
 
         # should be no running containers now
         response = self._client.getRunningContainers()
@@ -162,11 +186,18 @@ class TestServerAPI(unittest.TestCase):
         # transition container two to RUNNING
         self._checkAgentResponse("two", ContainerState.RUNNING, ManagerResponse.OKAY)
 
+        # should be one running container
+        response = self._client.getRunningContainers()
+        self.assertEqual(len(response.tags), 1)
+
         # stop the second container
         stopRequest = StopContainerRequest("two")
         self._client.stopContainer(stopRequest)
 
-        self._checkContainerInfos({"two": ContainerState.STOPPING}, 1)
+        # one batched check: "one" stayed DEAD and "two" is now STOPPING
+        self._checkContainerInfos(
+            {"one": ContainerState.DEAD, "two": ContainerState.STOPPING}, 2
+        )
 
         # deleting a stopping/running container should fail
         with self.assertRaises(InvalidOperation):
@@ -178,8 +209,10 @@ class TestServerAPI(unittest.TestCase):
         # report second container died and manager should now say OKAY
         self._checkAgentResponse("two", ContainerState.DEAD, ManagerResponse.OKAY)
 
-        # should also be dead now
-        self._checkContainerInfos({"two": ContainerState.DEAD}, 1)
+        # both should be dead now; one listContainers covers the pair
+        self._checkContainerInfos(
+            {"one": ContainerState.DEAD, "two": ContainerState.DEAD}, 2
+        )
 
         # start container not in READY state should fail
         with self.assertRaises(InvalidOperation):
@@ -187,9 +220,10 @@ class TestServerAPI(unittest.TestCase):
             request = StartContainerRequest("one", Command("/bin/echo", ["howdy"]))
             self._client.startContainer(request)
 
-        # delete all containers
+        # delete all containers with one request object
+        request = DeleteContainerRequest()
         for tag in ctags:
-            request = DeleteContainerRequest(tag)
+            request.tag = tag
             self._client.deleteContainer(request)
 
         # an unknown container deletion should fail